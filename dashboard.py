@@ -4,9 +4,12 @@ import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime, timedelta
 import os
-from supabase import create_client, Client
+from supabase import Client
 from dotenv import load_dotenv
 import pytz
+from db import get_supabase
+from renewables import RENEWABLE_SOURCES, renewable_percentage
+from tsdownsample import LTTBDownsampler
 
 # Load environment variables
 load_dotenv()
@@ -19,10 +22,47 @@ if not SUPABASE_URL or not SUPABASE_KEY:
     st.error("SUPABASE_URL and/or SUPABASE_KEY environment variables not set")
     st.stop()
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+supabase: Client = get_supabase(SUPABASE_URL, SUPABASE_KEY)
 
-# Define renewable energy sources
-RENEWABLE_SOURCES = ['solar', 'wind', 'hydro', 'biomass']
+# How long (in seconds) query results are cached before hitting Supabase again
+CACHE_TTL = 300
+
+# Maximum number of points plotted on the trend chart
+TREND_MAX_POINTS = 1000
+
+@st.cache_data(ttl=CACHE_TTL)
+def fetch_latest_created_at():
+    """Fetch only the timestamp of the most recent generation mix row"""
+    rows = supabase.table('generation_mix').select('created_at').order('created_at', desc=True).limit(1).execute().data
+    return rows[0]['created_at'] if rows else None
+
+@st.cache_data(ttl=CACHE_TTL)
+def fetch_generation_mix(created_at=None):
+    """Fetch the generation mix row written at `created_at`, or the latest row if not given"""
+    # Keyed on the header's timestamp so the tab shows the same row as the "Last updated" caption
+    query = supabase.table('generation_mix').select('created_at, generation_mix')
+    if created_at:
+        query = query.eq('created_at', created_at)
+    else:
+        query = query.order('created_at', desc=True)
+    return query.limit(1).execute().data
+
+@st.cache_data(ttl=CACHE_TTL)
+def fetch_trend(days=30):
+    """Fetch precomputed renewable percentages for the last `days` days"""
+    # The window is computed inside the cached function so reruns share one cache entry
+    end_date = datetime.now()
+    start_date = end_date - timedelta(days=days)
+    start_datetime = start_date.isoformat()
+    end_datetime = end_date.isoformat()
+
+    # renewable_pct is computed by the ETL at write time, so only scalars come back
+    return supabase.table('generation_mix').select('created_at, renewable_pct').gte('created_at', start_datetime).lte('created_at', end_datetime).order('created_at').execute().data
+
+@st.cache_data(ttl=CACHE_TTL)
+def fetch_latest_regional():
+    """Fetch the most recent regional intensity row"""
+    return supabase.table('regional_intensity').select('created_at, regions').order('created_at', desc=True).limit(1).execute().data
 
 # Set up the page
 st.set_page_config(
@@ -34,40 +74,154 @@ st.set_page_config(
 st.title("🌱 How Renewable is My Energy?")
 
 # Key metric - current renewable percentage
+latest_created_at = None
 try:
-    # Fetch latest generation mix data
-    response = supabase.table('generation_mix').select('*').order('created_at', desc=True).limit(1).execute()
+    # Only the timestamp is needed here, not the full generation mix
+    latest_created_at = fetch_latest_created_at()
     
-    if response.data:
-        latest_data = response.data[0]
-        generation_mix = latest_data['generation_mix']
-        
-        # Calculate renewable percentage
-        df_gen = pd.DataFrame(generation_mix)
-        renewable_df = df_gen[df_gen['fuel'].isin(RENEWABLE_SOURCES)]
-        renewable_percentage = renewable_df['perc'].sum()
-
+    if latest_created_at:
         # Display last updated time in British time
-        updated_time = datetime.fromisoformat(latest_data['created_at'].replace('Z', '+00:00'))
+        updated_time = datetime.fromisoformat(latest_created_at.replace('Z', '+00:00'))
         bst_time = updated_time.astimezone(pytz.timezone('Europe/London'))
         st.caption(f"Last updated: {bst_time.strftime('%B %d, %Y at %H:%M')} (GMT)")
 except Exception as e:
     st.error(f"Error calculating renewable percentage: {str(e)}")
 
-# Tabs for different views
-tab1, tab2 = st.tabs(["National Data", "Regional Data"])
+# Figures are cached per dataset, keyed on the created_at of the newest row they show
+@st.cache_data(ttl=CACHE_TTL)
+def build_pie_fig(created_at, _df):
+    """Build the generation mix pie chart"""
+    # Define colors: green shades for renewables, red shades for non-renewables
+    renewable_colors = ['#2E8B57', '#32CD32', '#90EE90', '#006400']  # Greens for renewables
+    non_renewable_colors = ['#DC143C', '#B22222', '#8B0000', '#CD5C5C', '#A52A2A']  # Different shades of red for non-renewables
+
+    # Group renewables first, each group sorted by percentage (largest first), in a single sort
+    chart_df = _df.assign(_is_renew=_df['fuel'].isin(RENEWABLE_SOURCES))\
+        .sort_values(['_is_renew', 'perc'], ascending=[False, False])\
+        .reset_index(drop=True)
+    renewable_fuels = chart_df.loc[chart_df['_is_renew'], 'fuel']
+    non_renewable_fuels = chart_df.loc[~chart_df['_is_renew'], 'fuel']
+    chart_df = chart_df.drop(columns='_is_renew')
+
+    # Create color map based on fuel type
+    color_map = {
+        fuel: renewable_colors[i % len(renewable_colors)]
+        for i, fuel in enumerate(renewable_fuels)
+    }
+    color_map.update({
+        fuel: non_renewable_colors[i % len(non_renewable_colors)]
+        for i, fuel in enumerate(non_renewable_fuels)
+    })
+
+    # Create pie chart with grouped colors
+    fig_pie = px.pie(
+        chart_df,
+        values='perc',
+        names='fuel',
+        title=f"Live Energy Generation Mix<br><sup>Renewables (green) vs Non-renewables (red)</sup>",
+        color='fuel',
+        color_discrete_map=color_map,
+        hover_data=['perc']
+    )
+
+    # Simplify hover information to just show the fuel type name
+    fig_pie.update_traces(
+        hovertemplate="<b>%{label}</b><br>%{percent}<extra></extra>"
+    )
+
+    # Remove any pull effects to keep the pie chart unified
+    fig_pie.update_traces(pull=0)
+
+    # Move legend closer to the pie chart
+    fig_pie.update_layout(
+        legend=dict(
+            orientation="v",
+            yanchor="middle",
+            y=0.5,
+            xanchor="left",
+            x=0.95,  # Position closer to the chart
+            traceorder="normal",
+            font=dict(size=12)
+        ),
+        margin=dict(l=20, r=100, t=60, b=20)  # Adjust margins to accommodate legend
+    )
+
+    return fig_pie
+
+@st.cache_data(ttl=CACHE_TTL)
+def build_regional_fig(created_at, _df):
+    """Build the regional renewable percentage bar chart"""
+    fig = px.bar(
+        _df,
+        x='region',
+        y='renewable_percentage',
+        color='intensity_index',
+        title=f"Renewable Energy Percentage by Region",
+        labels={'renewable_percentage': 'Renewable %', 'region': 'Region'},
+        color_discrete_map={
+            'very low': '#2E8B57',
+            'low': '#90EE90',
+            'moderate': '#FFD700',
+            'high': '#FF8C00',
+            'very high': '#FF0000'
+        }
+    )
+    fig.update_layout(xaxis_tickangle=-45)
+
+    return fig
+
+@st.cache_data(ttl=CACHE_TTL)
+def build_trend_fig(created_at, _trend_records):
+    """Build the renewable percentage trend line chart"""
+    # Renewable percentages are precomputed by the ETL; build the frame in one go
+    times = [record['created_at'] for record in _trend_records]
+    pcts = [record['renewable_pct'] for record in _trend_records]
+    df_trend = pd.DataFrame({
+        'timestamp': pd.to_datetime(times, utc=True),
+        'renewable_percentage': pcts
+    })
+
+    # Downsample long series with LTTB so the chart stays responsive
+    if len(df_trend) > TREND_MAX_POINTS:
+        idx = LTTBDownsampler().downsample(
+            df_trend['timestamp'].astype('int64').to_numpy(),
+            df_trend['renewable_percentage'].to_numpy(dtype=float),
+            n_out=TREND_MAX_POINTS
+        )
+        df_trend = df_trend.iloc[idx]
+
+    # Create time series chart
+    fig_line = px.line(
+        df_trend,
+        x='timestamp',
+        y='renewable_percentage',
+        title="Renewable Energy Percentage Over Time (Last 30 Days)",
+        labels={'renewable_percentage': 'Renewable %', 'timestamp': 'Time'},
+        markers=True,
+        render_mode='webgl'  # Render with WebGL so long series don't stall the browser
+    )
+    fig_line.update_layout(hovermode="x unified")
+
+    # Update hover template to show only the percentage
+    fig_line.update_traces(
+        hovertemplate="<b>%{y:.1f}%</b><extra></extra>"
+    )
+
+    return fig_line
 
 # Tab 1: National Data (Generation Mix and Trends)
-with tab1:
+@st.fragment
+def render_national_tab(created_at):
+    """Render the National Data tab for the row written at `created_at` (latest row if None)"""
     st.header("Energy Generation Mix")
     
     try:
-        # Fetch generation mix data
-        response = supabase.table('generation_mix').select('*').order('created_at', desc=True).limit(1).execute()
+        # Fetch the full generation mix for the chart and table
+        latest = fetch_generation_mix(created_at)
         
-        if response.data:
+        if latest:
             # Get the latest generation mix
-            latest_data = response.data[0]
+            latest_data = latest[0]
             generation_mix = latest_data['generation_mix']
             
             # Convert to DataFrame
@@ -88,118 +242,17 @@ with tab1:
             
             # Pie chart
             with col1:
-                # Define colors: green shades for renewables, red shades for non-renewables
-                renewable_colors = ['#2E8B57', '#32CD32', '#90EE90', '#006400']  # Greens for renewables
-                non_renewable_colors = ['#DC143C', '#B22222', '#8B0000', '#CD5C5C', '#A52A2A']  # Different shades of red for non-renewables
-                
-                # Create a copy of the dataframe
-                chart_df = df.copy()
-                
-                # Simple sorting by fuel type to achieve grouping
-                # First separate renewables and non-renewables
-                renewables_df = chart_df[chart_df['fuel'].isin(RENEWABLE_SOURCES)].copy()
-                non_renewables_df = chart_df[~chart_df['fuel'].isin(RENEWABLE_SOURCES)].copy()
-                
-                # Sort each group by percentage (largest first)
-                renewables_df = renewables_df.sort_values('perc', ascending=False)
-                non_renewables_df = non_renewables_df.sort_values('perc', ascending=False)
-                
-                # Combine them with renewables first
-                chart_df = pd.concat([renewables_df, non_renewables_df]).reset_index(drop=True)
-                
-                # Create color map based on fuel type
-                color_map = {}
-                renewable_idx = 0
-                non_renewable_idx = 0
-                
-                for _, row in chart_df.iterrows():
-                    fuel = row['fuel']
-                    if fuel in RENEWABLE_SOURCES:
-                        color_map[fuel] = renewable_colors[renewable_idx % len(renewable_colors)]
-                        renewable_idx += 1
-                    else:
-                        color_map[fuel] = non_renewable_colors[non_renewable_idx % len(non_renewable_colors)]
-                        non_renewable_idx += 1
-                
-                # Create pie chart with grouped colors
-                fig_pie = px.pie(
-                    chart_df,
-                    values='perc',
-                    names='fuel',
-                    title=f"Live Energy Generation Mix<br><sup>Renewables (green) vs Non-renewables (red)</sup>",
-                    color='fuel',
-                    color_discrete_map=color_map,
-                    hover_data=['perc']
-                )
-                
-                # Simplify hover information to just show the fuel type name
-                fig_pie.update_traces(
-                    hovertemplate="<b>%{label}</b><br>%{percent}<extra></extra>"
-                )
-                
-                # Remove any pull effects to keep the pie chart unified
-                fig_pie.update_traces(pull=0)
-                
-                # Move legend closer to the pie chart
-                fig_pie.update_layout(
-                    legend=dict(
-                        orientation="v",
-                        yanchor="middle",
-                        y=0.5,
-                        xanchor="left",
-                        x=0.95,  # Position closer to the chart
-                        traceorder="normal",
-                        font=dict(size=12)
-                    ),
-                    margin=dict(l=20, r=100, t=60, b=20)  # Adjust margins to accommodate legend
-                )
-                
+                fig_pie = build_pie_fig(latest_data['created_at'], df)
                 st.plotly_chart(fig_pie, use_container_width=True)
             
             # Time series chart
             with col2:
                 # Renewable Energy Trends
                 # Fetch historical generation mix data (last 30 days)
-                end_date = datetime.now()
-                start_date = end_date - timedelta(days=30)
-                start_datetime = start_date.isoformat()
-                end_datetime = end_date.isoformat()
-                
-                response_trend = supabase.table('generation_mix').select('*').gte('created_at', start_datetime).lte('created_at', end_datetime).order('created_at').execute()
+                trend_records = fetch_trend(days=30)
                 
-                if response_trend.data:
-                    # Process data to calculate renewable percentages over time
-                    trend_data = []
-                    for record in response_trend.data:
-                        gen_mix = record['generation_mix']
-                        df_trend = pd.DataFrame(gen_mix)
-                        renewable_df = df_trend[df_trend['fuel'].isin(RENEWABLE_SOURCES)]
-                        renewable_pct = renewable_df['perc'].sum() if not renewable_df.empty else 0
-                        
-                        trend_data.append({
-                            'timestamp': record['created_at'],
-                            'renewable_percentage': renewable_pct
-                        })
-                    
-                    # Convert to DataFrame and plot
-                    df_trend = pd.DataFrame(trend_data)
-                    df_trend['timestamp'] = pd.to_datetime(df_trend['timestamp'])
-                    
-                    # Create time series chart
-                    fig_line = px.line(
-                        df_trend,
-                        x='timestamp',
-                        y='renewable_percentage',
-                        title="Renewable Energy Percentage Over Time (Last 30 Days)",
-                        labels={'renewable_percentage': 'Renewable %', 'timestamp': 'Time'},
-                        markers=True
-                    )
-                    fig_line.update_layout(hovermode="x unified")
-                    
-                    # Update hover template to show only the percentage
-                    fig_line.update_traces(
-                        hovertemplate="<b>%{y:.1f}%</b><extra></extra>"
-                    )
+                if trend_records:
+                    fig_line = build_trend_fig(trend_records[-1]['created_at'], trend_records)
                     st.plotly_chart(fig_line, use_container_width=True)
                 else:
                     st.info("No historical data available for trends")
@@ -217,56 +270,40 @@ with tab1:
         st.error(f"Error fetching generation mix data: {str(e)}")
 
 # Tab 2: Regional Data
-with tab2:
+@st.fragment
+def render_regional_tab():
+    """Render the Regional Data tab"""
     st.header("Regional Renewable Energy Data")
     
     try:
         # Fetch regional data
-        response = supabase.table('regional_intensity').select('*').order('created_at', desc=True).limit(1).execute()
+        latest_regional = fetch_latest_regional()
         
-        if response.data:
+        if latest_regional:
             # Get the latest regional data
-            latest_data = response.data[0]
+            latest_data = latest_regional[0]
             regions = latest_data['regions']
             
-            # Convert to DataFrame and calculate renewable percentages
-            df_list = []
+            # Renewable percentages are precomputed per region by the ETL; compute them for
+            # older rows that lack the value (regions without a generation mix count as 0%)
             for region in regions:
-                # Calculate renewable percentage for this region
-                renewable_pct = 0
-                if 'generationmix' in region:
-                    gen_mix_df = pd.DataFrame(region['generationmix'])
-                    renewable_df = gen_mix_df[gen_mix_df['fuel'].isin(RENEWABLE_SOURCES)]
-                    renewable_pct = renewable_df['perc'].sum() if not renewable_df.empty else 0
-                
-                df_list.append({
-                    'region': region['shortname'],
-                    'intensity_forecast': region['intensity']['forecast'],
-                    'intensity_index': region['intensity']['index'],
-                    'region_id': region['regionid'],
-                    'renewable_percentage': renewable_pct
-                })
+                if 'renewable_pct' not in region:
+                    region['renewable_pct'] = renewable_percentage(region.get('generationmix', []))
             
-            df = pd.DataFrame(df_list)
+            df = pd.json_normalize(regions)[
+                ['shortname', 'regionid', 'intensity.forecast', 'intensity.index', 'renewable_pct']
+            ]
+            df = df.rename(columns={
+                'shortname': 'region',
+                'regionid': 'region_id',
+                'intensity.forecast': 'intensity_forecast',
+                'intensity.index': 'intensity_index',
+                'renewable_pct': 'renewable_percentage'
+            })
             df = df.sort_values('renewable_percentage', ascending=False)
             
             # Create bar chart for renewable percentages by region
-            fig = px.bar(
-                df,
-                x='region',
-                y='renewable_percentage',
-                color='intensity_index',
-                title=f"Renewable Energy Percentage by Region",
-                labels={'renewable_percentage': 'Renewable %', 'region': 'Region'},
-                color_discrete_map={
-                    'very low': '#2E8B57',
-                    'low': '#90EE90',
-                    'moderate': '#FFD700',
-                    'high': '#FF8C00',
-                    'very high': '#FF0000'
-                }
-            )
-            fig.update_layout(xaxis_tickangle=-45)
+            fig = build_regional_fig(latest_data['created_at'], df)
             st.plotly_chart(fig, use_container_width=True)
             
             # Display metrics for top 5 regions by renewable energy
@@ -293,4 +330,13 @@ with tab2:
         else:
             st.info("No regional data available")
     except Exception as e:
-        st.error(f"Error fetching regional data: {str(e)}")
\ No newline at end of file
+        st.error(f"Error fetching regional data: {str(e)}")
+
+# Tabs for different views; the tabs are fragments so any widgets added to them rerun only that tab
+tab1, tab2 = st.tabs(["National Data", "Regional Data"])
+
+with tab1:
+    render_national_tab(latest_created_at)
+
+with tab2:
+    render_regional_tab()
\ No newline at end of file
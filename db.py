@@ -0,0 +1,8 @@
+from functools import lru_cache
+from supabase import create_client, Client
+
+
+@lru_cache(maxsize=1)
+def get_supabase(supabase_url: str, supabase_key: str) -> Client:
+    """Return a Supabase client, created once per process and reused afterwards"""
+    return create_client(supabase_url, supabase_key)
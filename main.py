@@ -1,10 +1,17 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import argparse
 import json
+import orjson
 import os
 from datetime import datetime, timedelta
-from supabase import create_client, Client
+from concurrent.futures import ThreadPoolExecutor
+from supabase import Client
+from postgrest.exceptions import APIError
 from dotenv import load_dotenv
+from db import get_supabase
+from renewables import renewable_percentage
 
 load_dotenv()
 
@@ -13,15 +20,31 @@ class CarbonIntensityETL:
         self.base_url = "https://api.carbonintensity.org.uk"
         self.session = requests.Session()
 
+        self.session.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'User-Agent': 'carbon-etl/1.0'
+        })
+
+        # Retry transient API failures, and size the connection pool so the
+        # three extract calls can run concurrently over kept-alive connections
+        retry = Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['GET']
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=3, pool_maxsize=3)
+        self.session.mount('https://', adapter)
+
         # Initialize Supabase client
-        self.supabase: Client = create_client(supabase_url, supabase_key)
+        self.supabase: Client = get_supabase(supabase_url, supabase_key)
 
     def extract_intensity_data(self):
         try:
             response = self.session.get(f"{self.base_url}/intensity")
             response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
+            return orjson.loads(response.content)
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
             print(f"Error fetching intensity data: {e}")
             return None
 
@@ -29,8 +52,8 @@ class CarbonIntensityETL:
         try:
             response = self.session.get(f"{self.base_url}/generation")
             response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
+            return orjson.loads(response.content)
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
             print(f"Error fetching generation data: {e}")
             return None
 
@@ -38,8 +61,8 @@ class CarbonIntensityETL:
         try:
             response = self.session.get(f"{self.base_url}/regional")
             response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
+            return orjson.loads(response.content)
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
             print(f"Error fetching regional data: {e}")
             return None
 
@@ -74,7 +97,8 @@ class CarbonIntensityETL:
             return {
                 'from_time': generation_data.get('from', 'N/A'),
                 'to_time': generation_data.get('to', 'N/A'),
-                'generation_mix': mix_sorted  # Store as Python object (will be converted to JSONB by Supabase)
+                'generation_mix': mix_sorted,  # Store as Python object (will be converted to JSONB by Supabase)
+                'renewable_pct': renewable_percentage(mix_sorted)
             }
         except Exception as e:
             print(f"Error transforming generation data: {e}")
@@ -88,6 +112,10 @@ class CarbonIntensityETL:
         try:
             regions_data = data.get('data', [{}])[0].get('regions', [])
 
+            # Precompute each region's renewable percentage so the dashboard doesn't have to
+            for region in regions_data:
+                region['renewable_pct'] = renewable_percentage(region.get('generationmix', []))
+
             # Sort by forecast intensity (descending)
             regions_sorted = sorted(regions_data, key=lambda x: x.get('intensity', {}).get('forecast', 0), reverse=True)
 
@@ -139,6 +167,37 @@ class CarbonIntensityETL:
             print(f"Error saving regional data to Supabase: {e}")
             return False
 
+    def load_all_data(self, intensity_data, generation_data, regional_data):
+        """Save all three datasets to Supabase in a single round trip"""
+        try:
+            self.supabase.rpc('etl_insert_all', {
+                'p_intensity': intensity_data,
+                'p_generation': generation_data,
+                'p_regional': regional_data
+            }).execute()
+            print(f"✓ All data saved to Supabase in one transaction")
+            return True
+        except APIError as e:
+            # Only fall back when the function hasn't been created; any other error may
+            # have happened after the transaction committed, so retrying would duplicate rows
+            if e.code != 'PGRST202':
+                print(f"Error saving data to Supabase: {e}")
+                return False
+            print(f"etl_insert_all function not found, falling back to per-table inserts")
+        except Exception as e:
+            print(f"Error saving data to Supabase: {e}")
+            return False
+
+        # Fallback: run the per-table inserts concurrently
+        loads = [
+            (self.load_intensity_data, intensity_data),
+            (self.load_generation_data, generation_data),
+            (self.load_regional_data, regional_data)
+        ]
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            results = list(executor.map(lambda load: load[0](load[1]), loads))
+        return all(results)
+
     def create_tables_if_not_exist(self):
         """Create tables in Supabase if they don't exist (requires SQL execution)"""
         print("Note: Ensure the following tables exist in your Supabase database:")
@@ -160,6 +219,7 @@ class CarbonIntensityETL:
             from_time TEXT,
             to_time TEXT,
             generation_mix JSONB,
+            renewable_pct FLOAT,
             created_at TIMESTAMPTZ DEFAULT NOW()
         );
 
@@ -171,6 +231,96 @@ class CarbonIntensityETL:
             regions JSONB,
             created_at TIMESTAMPTZ DEFAULT NOW()
         );
+
+        -- Indexes for latest-row lookups, time-range scans and cleanup
+        CREATE INDEX IF NOT EXISTS idx_ci_created_at ON carbon_intensity (created_at DESC);
+        CREATE INDEX IF NOT EXISTS idx_gm_created_at ON generation_mix (created_at DESC);
+        CREATE INDEX IF NOT EXISTS idx_ri_created_at ON regional_intensity (created_at DESC);
+
+        -- Add and backfill renewable_pct on existing generation_mix tables
+        ALTER TABLE generation_mix ADD COLUMN IF NOT EXISTS renewable_pct FLOAT;
+        UPDATE generation_mix gm
+        SET renewable_pct = (
+            SELECT COALESCE(SUM((elem->>'perc')::FLOAT), 0)
+            FROM jsonb_array_elements(gm.generation_mix) AS elem
+            WHERE elem->>'fuel' IN ('solar', 'wind', 'hydro', 'biomass')
+        )
+        WHERE renewable_pct IS NULL;
+
+        -- Backfill renewable_pct inside each stored region object
+        UPDATE regional_intensity ri
+        SET regions = (
+            SELECT jsonb_agg(
+                r.region || jsonb_build_object('renewable_pct', (
+                    SELECT COALESCE(SUM((elem->>'perc')::FLOAT), 0)
+                    FROM jsonb_array_elements(COALESCE(r.region->'generationmix', '[]'::JSONB)) AS elem
+                    WHERE elem->>'fuel' IN ('solar', 'wind', 'hydro', 'biomass')
+                ))
+                ORDER BY r.ord
+            )
+            FROM jsonb_array_elements(ri.regions) WITH ORDINALITY AS r(region, ord)
+        )
+        WHERE EXISTS (
+            SELECT 1 FROM jsonb_array_elements(ri.regions) AS region
+            WHERE NOT region ? 'renewable_pct'
+        );
+
+        -- Insert all three datasets in one transaction (called via RPC)
+        CREATE OR REPLACE FUNCTION etl_insert_all(p_intensity JSONB, p_generation JSONB, p_regional JSONB)
+        RETURNS VOID AS $$
+        BEGIN
+            IF p_intensity IS NOT NULL THEN
+                INSERT INTO carbon_intensity (from_time, to_time, forecast, actual, index)
+                VALUES (
+                    p_intensity->>'from_time',
+                    p_intensity->>'to_time',
+                    (p_intensity->>'forecast')::INTEGER,
+                    (p_intensity->>'actual')::INTEGER,
+                    p_intensity->>'index'
+                );
+            END IF;
+
+            IF p_generation IS NOT NULL THEN
+                INSERT INTO generation_mix (from_time, to_time, generation_mix, renewable_pct)
+                VALUES (
+                    p_generation->>'from_time',
+                    p_generation->>'to_time',
+                    p_generation->'generation_mix',
+                    (p_generation->>'renewable_pct')::FLOAT
+                );
+            END IF;
+
+            IF p_regional IS NOT NULL THEN
+                INSERT INTO regional_intensity (from_time, to_time, regions)
+                VALUES (
+                    p_regional->>'from_time',
+                    p_regional->>'to_time',
+                    p_regional->'regions'
+                );
+            END IF;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        -- Delete old rows from all tables in one transaction (called via RPC)
+        CREATE OR REPLACE FUNCTION cleanup_old(cutoff TIMESTAMPTZ)
+        RETURNS TABLE (table_name TEXT, deleted_count INTEGER) AS $$
+        BEGIN
+            DELETE FROM carbon_intensity WHERE created_at < cutoff;
+            GET DIAGNOSTICS deleted_count = ROW_COUNT;
+            table_name := 'carbon_intensity';
+            RETURN NEXT;
+
+            DELETE FROM generation_mix WHERE created_at < cutoff;
+            GET DIAGNOSTICS deleted_count = ROW_COUNT;
+            table_name := 'generation_mix';
+            RETURN NEXT;
+
+            DELETE FROM regional_intensity WHERE created_at < cutoff;
+            GET DIAGNOSTICS deleted_count = ROW_COUNT;
+            table_name := 'regional_intensity';
+            RETURN NEXT;
+        END;
+        $$ LANGUAGE plpgsql;
         """)
 
     def run_etl_pipeline(self):
@@ -181,10 +331,15 @@ class CarbonIntensityETL:
         try:
             print(f"\n{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Running ETL cycle...")
 
-            # Extract
-            intensity_raw = self.extract_intensity_data()
-            generation_raw = self.extract_generation_data()
-            regional_raw = self.extract_regional_data()
+            # Extract (the three API calls are independent, so run them concurrently)
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                intensity_future = executor.submit(self.extract_intensity_data)
+                generation_future = executor.submit(self.extract_generation_data)
+                regional_future = executor.submit(self.extract_regional_data)
+
+                intensity_raw = intensity_future.result()
+                generation_raw = generation_future.result()
+                regional_raw = regional_future.result()
 
             # Transform
             intensity_transformed = self.transform_intensity_data(intensity_raw)
@@ -192,9 +347,7 @@ class CarbonIntensityETL:
             regional_transformed = self.transform_regional_data(regional_raw)
 
             # Load to Supabase
-            intensity_saved = self.load_intensity_data(intensity_transformed)
-            generation_saved = self.load_generation_data(generation_transformed)
-            regional_saved = self.load_regional_data(regional_transformed)
+            self.load_all_data(intensity_transformed, generation_transformed, regional_transformed)
 
         except Exception as e:
             print(f"\nUnexpected error in ETL pipeline: {e}")
@@ -209,32 +362,38 @@ class CarbonIntensityETL:
         print(f"Cleaning up data older than {cutoff_date.strftime('%Y-%m-%d %H:%M:%S')}...")
         
         try:
-            # Clean up carbon_intensity table
-            result = self.supabase.table('carbon_intensity')\
-                .delete()\
-                .lt('created_at', cutoff_iso)\
-                .execute()
-            print(f"✓ Deleted {len(result.data) if result.data else 0} old records from carbon_intensity")
+            # Clean up all tables in a single transaction
+            result = self.supabase.rpc('cleanup_old', {'cutoff': cutoff_iso}).execute()
+            for row in result.data or []:
+                print(f"✓ Deleted {row['deleted_count']} old records from {row['table_name']}")
             
-            # Clean up generation_mix table
-            result = self.supabase.table('generation_mix')\
-                .delete()\
-                .lt('created_at', cutoff_iso)\
-                .execute()
-            print(f"✓ Deleted {len(result.data) if result.data else 0} old records from generation_mix")
+            print("Cleanup process completed successfully.")
+            return True
             
-            # Clean up regional_intensity table
-            result = self.supabase.table('regional_intensity')\
-                .delete()\
-                .lt('created_at', cutoff_iso)\
-                .execute()
-            print(f"✓ Deleted {len(result.data) if result.data else 0} old records from regional_intensity")
+        except APIError as e:
+            if e.code != 'PGRST202':
+                print(f"Error during cleanup process: {e}")
+                return False
+            print(f"cleanup_old function not found, falling back to per-table deletes")
+        except Exception as e:
+            print(f"Error during cleanup process: {e}")
+            return False
+        
+        # Fallback: delete from each table separately
+        try:
+            for table in ['carbon_intensity', 'generation_mix', 'regional_intensity']:
+                result = self.supabase.table(table)\
+                    .delete()\
+                    .lt('created_at', cutoff_iso)\
+                    .execute()
+                print(f"✓ Deleted {len(result.data) if result.data else 0} old records from {table}")
             
             print("Cleanup process completed successfully.")
+            return True
             
         except Exception as e:
             print(f"Error during cleanup process: {e}")
-
+            return False
 
 if __name__ == "__main__":
 
@@ -253,6 +412,8 @@ if __name__ == "__main__":
     etl = CarbonIntensityETL(SUPABASE_URL, SUPABASE_KEY)
 
     if args.cleanup_only:
-        etl.run_cleanup_only()
+        # Exit non-zero so a failed cleanup shows up as a failed scheduled job
+        if not etl.run_cleanup_only():
+            exit(1)
     else:
         etl.run_etl_pipeline()
\ No newline at end of file
@@ -0,0 +1,7 @@
+# Define renewable energy sources
+RENEWABLE_SOURCES = frozenset(['solar', 'wind', 'hydro', 'biomass'])
+
+
+def renewable_percentage(generation_mix):
+    """Sum the percentages of the renewable fuels in a generation mix"""
+    return sum(x['perc'] for x in generation_mix if x['fuel'] in RENEWABLE_SOURCES)